@@ -1,13 +1,21 @@
 import argparse
-import glob
+import ctypes
 import hashlib
+import http.client
+import itertools
 import platform
 import shutil
 import subprocess
+import sys
 import os
+import re
 import shlex
 import stat
+import time
+import urllib.error
 import urllib.request
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, wait
+from functools import cached_property, lru_cache
 from pathlib import Path
 from osxrelocator import OSXRelocator
 from depstracker import DepsTracker
@@ -19,31 +27,149 @@ GST_TEMPLATE = {
     'Darwin': "gstreamer-1.0{}-{}-universal.pkg"
 }
 GST_URL_TEMPLATE = {
-    'Windows': "https://gstreamer.freedesktop.org/data/pkg/windows/{}/msvc/",
+    'Windows': "https://gstreamer.freedesktop.org/data/pkg/windows/{}/msvc",
     'Darwin': "https://gstreamer.freedesktop.org/data/pkg/osx/{}"
 }
 
-
-def download(url, output_file=None, md5=None):
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 5
+
+CLONE_NOFOLLOW = 0x0001
+
+
+def sha256sum(path):
+    with open(path, "rb") as f:
+        # file_digest() (Python >= 3.11) hashes in C with the GIL released
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+def get_published_sha256(url):
+    ''' Returns the checksum published in <url>.sha256sum, or None '''
+    try:
+        with urllib.request.urlopen(f"{url}.sha256sum", timeout=DOWNLOAD_TIMEOUT) as response:
+            # "<sha256>  <filename>"
+            return response.read().decode().split()[0].lower()
+    except (urllib.error.URLError, ConnectionError, TimeoutError, IndexError) as e:
+        print(f"WARNING: no published checksum for {url} ({e})")
+        return None
+
+
+def _get_validator(response):
+    # If-Range only accepts strong ETags, fall back to Last-Modified
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def _fetch(url, output_file):
+    # Download to a .part file and resume it with a Range request if the
+    # transfer is interrupted, so a retry only fetches the missing bytes.
+    # The validator of the partial body is stored next to it and sent in
+    # If-Range, if the remote file changed the server sends it whole.
+    part_file = f"{output_file}.part"
+    validator_file = f"{part_file}.validator"
+    for attempt in range(DOWNLOAD_RETRIES):
+        headers = {"Accept-Encoding": "identity"}
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        if offset and os.path.exists(validator_file):
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = Path(validator_file).read_text()
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                # A 200 means the server ignored the range or the file
+                # changed, start over
+                if response.status == 206:
+                    mode = "ab"
+                else:
+                    mode = "wb"
+                    validator = _get_validator(response)
+                    if validator:
+                        Path(validator_file).write_text(validator)
+                    elif os.path.exists(validator_file):
+                        # Without a validator the body can't be resumed
+                        os.remove(validator_file)
+                with open(part_file, mode) as f:
+                    shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+            os.replace(part_file, output_file)
+            if os.path.exists(validator_file):
+                os.remove(validator_file)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code == 416:
+                # The partial file does not match the remote one anymore
+                os.remove(part_file)
+                continue
+            if e.code < 500 or attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            error = e
+        except (urllib.error.URLError, ConnectionError, TimeoutError,
+                http.client.IncompleteRead) as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            error = e
+        delay = 2 ** attempt
+        print(f"Download of {url} failed ({error}), retrying in {delay}s")
+        time.sleep(delay)
+    raise RuntimeError(f"Could not download {url}")
+
+
+def download(url, output_file=None, sha256=None):
     if output_file is None:
-        output_file = url.split("/")[:-1]
+        output_file = url.split("/")[-1]
     if os.path.exists(output_file):
-        if md5 is not None:
-            with open(output_file) as file_to_check:
-                data = file_to_check.read()
-                md5_returned = hashlib.md5(data).hexdigest()
-                if md5_returned == md5:
-                    print(f"File {output_file} already downloaded")
-                    return
-        else:
+        if sha256 is None or sha256sum(output_file) == sha256:
             print(f"File {output_file} already downloaded")
             return
+        print(f"File {output_file} does not match its checksum, downloading again")
+        os.remove(output_file)
     print(f"Downloading {url}")
-    urllib.request.urlretrieve(url, output_file)
+    _fetch(url, output_file)
+    if sha256 is not None and sha256sum(output_file) != sha256:
+        os.remove(output_file)
+        raise RuntimeError(f"Checksum mismatch for {url}")
     print(f"Downloaded {output_file}")
 
 
-def run(cmd, cwd=None, split=False):
+def download_all(downloads, max_workers=4):
+    ''' Runs download() for each (url, output_file[, sha256]) tuple
+    concurrently '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda d: download(*d), downloads))
+
+
+@lru_cache(maxsize=None)
+def _get_clonefile():
+    if platform.system() != 'Darwin':
+        return None
+    clonefile = ctypes.CDLL(None, use_errno=True).clonefile
+    clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+    clonefile.restype = ctypes.c_int
+    return clonefile
+
+
+def copyfile(src, dst):
+    ''' Copies src to dst, as a copy-on-write clone on APFS if possible '''
+    clonefile = _get_clonefile()
+    if clonefile is not None:
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        if clonefile(os.fsencode(src), os.fsencode(dst), CLONE_NOFOLLOW) == 0:
+            return
+    # Different volumes or a file system without clones
+    shutil.copyfile(src, dst)
+
+
+def run(cmd, cwd=None, split=False, stream=False, capture=True):
     if split:
         if isinstance(cmd, str):
             cmd = shlex.split(cmd)
@@ -51,28 +177,49 @@ def run(cmd, cwd=None, split=False):
         print(f"Running command: {' '.join([str(x) for x in cmd])} in {cwd}")
     else:
         print(f"Running command: {cmd} in {cwd}")
+    sys.stdout.flush()
+    if not capture:
+        # The output is not needed, let the command write to our stdout
+        subprocess.run(cmd, cwd=cwd, check=True)
+        return []
+    if not stream:
+        # Collect the whole output at once instead of pumping it line by line
+        result = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, cwd=cwd
+        )
+        print(result.stdout, end="")
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, cmd)
+        return result.stdout.splitlines()
     popen = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, universal_newlines=True, cwd=cwd
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd
     )
-    lines = []
-    for stdout_line in iter(popen.stdout.readline, ""):
-        lines.append(stdout_line.split('\n')[0])
-        print(stdout_line)
+    # Forward the raw output in large blocks as soon as it is available
+    output = bytearray()
+    fd = popen.stdout.fileno()
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        output += data
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
     popen.stdout.close()
     return_code = popen.wait()
     if return_code:
         raise subprocess.CalledProcessError(return_code, cmd)
-    return lines
+    return output.decode(errors="replace").splitlines()
 
 
 def replace(filepath, replacements):
     ''' Replaces keys in the 'replacements' dict with their values in file '''
-    with open(filepath, 'r') as f:
-        content = f.read()
-    for k, v in replacements.items():
-        content = content.replace(k, v)
-    with open(filepath, 'w+') as f:
-        f.write(content)
+    if not replacements:
+        return
+    pattern = re.compile('|'.join(re.escape(k) for k in replacements))
+    content = Path(filepath).read_text()
+    Path(filepath).write_text(
+        pattern.sub(lambda m: replacements[m.group()], content))
 
 
 class Build:
@@ -110,27 +257,40 @@ class Build:
             "--reconfigure",
         ]
 
+    @cached_property
+    def host_system(self):
+        return platform.system()
+
+    @cached_property
+    def tracker(self):
+        # Created on first use: it needs GStreamer to be installed already
+        return DepsTracker(self.host_system, self.gst_install_dir,
+                           self.cache_dir / "deps.json")
+
     def install_deps(self):
-        run(["pip3", "install", "--break-system-packages", "meson", "ninja"])
-        download("https://dist.nuget.org/win-x86-commandline/latest/nuget.exe",
-                 self.cache_dir / "nuget.exe")
+        # Fetch nuget while pip installs the build tools
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            nuget = executor.submit(
+                download, "https://dist.nuget.org/win-x86-commandline/latest/nuget.exe",
+                self.cache_dir / "nuget.exe")
+            run(["pip3", "install", "--break-system-packages", "meson", "ninja"])
+            nuget.result()
+
+    def download_gst_pkg(self):
+        # GStreamer publishes a .sha256sum file next to each package, use it
+        # to validate the cached packages and the new downloads
+        download_all([(url, path, get_published_sha256(url))
+                      for url, path in self._get_gst_pkgs()])
 
     def install_gst_pkg(self):
-        filename = GST_TEMPLATE[self.platform].format("", self.gst_version)
-        filename_devel = GST_TEMPLATE[self.platform].format(
-            "-devel", self.gst_version)
-        url = f"{GST_URL_TEMPLATE[self.platform].format(self.gst_version)}/{filename}"
-        url_devel = f"{GST_URL_TEMPLATE[self.platform].format(self.gst_version)}/{filename_devel}"
-        download(url, self.cache_dir / filename)
-        download(url_devel, self.cache_dir / filename_devel)
-        self._install_package(self.cache_dir / GST_TEMPLATE[self.platform].format("", self.gst_version),
-                              self.build_dir / "gst_install.log")
-        self._install_package(self.cache_dir / GST_TEMPLATE[self.platform].format("-devel", self.gst_version),
-                              self.build_dir / "gst_devel_install.log")
+        self.download_gst_pkg()
+        (_, path), (_, path_devel) = self._get_gst_pkgs()
+        self._install_package(path, self.build_dir / "gst_install.log")
+        self._install_package(path_devel, self.build_dir / "gst_devel_install.log")
 
     def clone_gst(self):
         if self.gst_dir.exists():
-            run(["git", "fetch"], self.gst_dir)
+            run(["git", "fetch"], self.gst_dir, stream=True)
         else:
             run(
                 [
@@ -142,14 +302,21 @@ class Build:
                     "--branch",
                     "1.24",
                 ],
+                stream=True,
             )
         run(["git", "reset", "--hard", GST_COMMIT], self.gst_dir)
 
     def configure_gst(self):
-        run(self.gst_configure_cmd)
+        run(self.gst_configure_cmd, stream=True)
 
     def compile_gst(self):
-        run(["meson", "compile", "-C", self.gst_build_dir])
+        run(["meson", "compile", "-C", self.gst_build_dir] + self._get_jobs_args(),
+            capture=False)
+
+    def _get_jobs_args(self, jobs=None):
+        cpu_count = os.cpu_count() or 1
+        jobs = jobs or cpu_count
+        return ["-j", str(jobs), "-l", str(cpu_count)]
 
     def install_gst(self):
         self.gst_plugins = Path("lib") / "gstreamer-1.0"
@@ -171,6 +338,15 @@ class Build:
         self.gst_native_debug.mkdir(parents=True, exist_ok=True)
         self.gst_native_plugins_debug.mkdir(parents=True, exist_ok=True)
 
+    def _get_dest_dirs(self):
+        ''' Maps install directories to their nuget directory, files from any
+        other directory go to gst_native '''
+        lib_dir = self.gst_install_dir / "lib"
+        return {
+            (lib_dir / "gstreamer-1.0").resolve(): self.gst_native_plugins,
+            (lib_dir / "gio" / "modules").resolve(): self.gst_native_gio_modules_dir,
+        }
+
     def install_gst_sharp_from_gstreamer(self):
         subprojects = self.gst_build_dir / "subprojects"
 
@@ -222,7 +398,7 @@ class Build:
             self.nuget_dir / f"{dst_name}.targets",
         )
 
-        open(self.nuget_dir / "_._", mode="w").close()
+        (self.nuget_dir / "_._").touch()
 
         run(
             self.nuget_cmd
@@ -235,12 +411,19 @@ class Build:
             self.build_dir,
         )
 
-    def _get_files_from_plugins(self, tracker: DepsTracker):
-        plugins = [x.split('\n')[0] for x in open(self.source_dir / "plugins_list.txt").readlines() if not x.startswith('#')]
-        plugins_files = [self._get_file_from_plugin_name(p) for p in plugins]
-        return tracker.list_deps(plugins_files)
+    def _get_all_dep_files(self, extra_files=()):
+        # Walk all the roots together so shared dependencies are only
+        # inspected once
+        return set(self.tracker.list_deps(
+            self._get_files_from_plugins() + self._get_files_from_libs()
+            + list(extra_files)))
+
+    def _get_files_from_plugins(self):
+        lines = (self.source_dir / "plugins_list.txt").read_text().splitlines()
+        plugins = [x for x in map(str.strip, lines) if x and not x.startswith('#')]
+        return [self._get_file_from_plugin_name(p) for p in plugins]
 
-    def _get_files_from_libs(self, tracker: DepsTracker):
+    def _get_files_from_libs(self):
         libs = ["gstreamer-1.0",
                 "gstapp-1.0",
                 "gstaudio-1.0",
@@ -257,8 +440,17 @@ class Build:
                 "gstvideo-1.0",
                 "gstwebrtc-1.0",
                 "ges-1.0"]
-        lib_files = [self._get_file_from_lib_name(p) for p in libs]
-        return tracker.list_deps(lib_files)
+        return [self._get_file_from_lib_name(p) for p in libs]
+
+    def _get_gst_pkgs(self):
+        template = GST_TEMPLATE[self.platform]
+        base_url = GST_URL_TEMPLATE[self.platform].format(self.gst_version)
+        filename = template.format("", self.gst_version)
+        filename_devel = template.format("-devel", self.gst_version)
+        return [
+            (f"{base_url}/{filename}", self.cache_dir / filename),
+            (f"{base_url}/{filename_devel}", self.cache_dir / filename_devel),
+        ]
 
     def _install_package(self, path, log_file):
         raise NotImplemented()
@@ -280,9 +472,20 @@ class Build:
         self.compile_gst()
 
     def all_deps(self):
-        self.install_deps()
+        # Fetching the tools, the GStreamer packages and the sources are
+        # independent network-bound steps, run them at the same time.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(self.install_deps),
+                executor.submit(self.download_gst_pkg),
+                executor.submit(self.clone_gst),
+            ]
+            wait(futures, return_when=ALL_COMPLETED)
+            for future in futures:
+                future.result()
         self.install_gst_pkg()
-        self.build_gst()
+        self.configure_gst()
+        self.compile_gst()
         self.install_gst()
         self.create_runtime_nuget_package()
         self.create_runtime_debug_nuget_package()
@@ -291,6 +494,8 @@ class Build:
 
 class BuildMacOS(Build):
 
+    ARCHS = ["x86_64", "arm64"]
+
     def __init__(self, source_dir: Path, build_dir: Path, cache_dir: Path = None):
         super().__init__('Darwin', 'osx', source_dir, build_dir, cache_dir)
         self.nuget_cmd = ["mono", self.cache_dir / "nuget.exe"]
@@ -326,30 +531,36 @@ class BuildMacOS(Build):
         return gst_configure_cmd
 
     def configure_gst(self):
-        gst_install_dir = self._get_gst_install_dir()
+        gst_install_dir = self.gst_install_dir
         os.environ["PKG_CONFIG"] = str(
             (gst_install_dir / "bin" / "pkg-config").absolute()
         )
         os.environ["PKG_CONFIG_LIBDIR"] = str(
             (gst_install_dir / "lib" / "pkgconfig").absolute()
         )
-        self.gst_configure_cmd = self._get_configure_cmd("x86_64")
-        super().configure_gst()
-        self.gst_configure_cmd = self._get_configure_cmd("arm64")
-        super().configure_gst()
+        # Each architecture has its own build dir, configure and build them
+        # at the same time
+        configure_cmds = [self._get_configure_cmd(arch) for arch in self.ARCHS]
+        with ThreadPoolExecutor(max_workers=len(self.ARCHS)) as executor:
+            list(executor.map(lambda c: run(c, stream=True), configure_cmds))
 
     def compile_gst(self):
-        run(["meson", "compile", "-C", self.gst_build_dir / "x86_64"])
-        run(["meson", "compile", "-C", self.gst_build_dir / "arm64"])
+        # Split the jobs between the builds so both use all CPUs together
+        jobs = max(1, (os.cpu_count() or 1) // len(self.ARCHS))
+        compile_cmds = [
+            ["meson", "compile", "-C", self.gst_build_dir / arch] + self._get_jobs_args(jobs)
+            for arch in self.ARCHS
+        ]
+        # Let the compilers write to our stdout as they go, like the base
+        # class does, so the log is live even if the two builds interleave
+        with ThreadPoolExecutor(max_workers=len(self.ARCHS)) as executor:
+            list(executor.map(lambda c: run(c, capture=False), compile_cmds))
 
     def install_gst(self):
         super().install_gst()
 
         # GStreamer
-        tracker = DepsTracker (platform.system(), self._get_gst_install_dir())
-        gst_install_dir = self._get_gst_install_dir()
-        lib_files = self._get_files_from_plugins(tracker)
-        lib_files += self._get_files_from_libs(tracker)
+        gst_install_dir = self.gst_install_dir
         gst_gio_openssl = gst_install_dir / "lib" / "gio" / "modules" / "libgioopenssl.so"
         gst_libsoup = gst_install_dir / "lib" / "libsoup-2.4.1.dylib"
         gst_inspect = gst_install_dir / "bin" / "gst-inspect-1.0"
@@ -357,20 +568,28 @@ class BuildMacOS(Build):
 
         i_gst_scanner = self.gst_native_scanner_dir / "gst-plugin-scanner"
         i_gst_inspect = self.gst_native_scanner_dir / "gst-inspect-1.0"
-        lib_files += tracker.list_deps(
+        lib_files = self._get_all_dep_files(
             [gst_gio_openssl, gst_libsoup, gst_inspect, gst_scanner]
         )
-        lib_files = set(lib_files)
 
         # The installer does not respect symlinks, copy only the real
         # library:
         # Pick libgobject-2.0.0.dylib and leave libgobject-2.0.dylib
+        # List each library directory once instead of stat'ing every file
+        entries = {}
+        for parent in {f.parent for f in lib_files}:
+            try:
+                with os.scandir(parent) as it:
+                    entries[parent] = {e.name: e for e in it}
+            except FileNotFoundError:
+                entries[parent] = {}
         files = {}
         for f in lib_files:
-            if not f.exists():
+            entry = entries[f.parent].get(f.name)
+            if entry is None:
                 print(f"File not found: {f}")
                 continue
-            if f.is_symlink():
+            if entry.is_symlink():
                 continue
             key = f.stem
             # Take the path with the longest path libgobject-2.0.0.dylib vs libgobject-2.0.dylib
@@ -380,73 +599,79 @@ class BuildMacOS(Build):
         relocator = OSXRelocator(False)
         strip = os.environ.get("STRIP", "strip")
 
-        for f in files.values():
-            if "lib/gstreamer-1.0" in str(f):
-                self.copy(f, self.gst_native_plugins, relocator, strip)
-            elif "lib/gio/modules" in str(f):
-                self.copy(f, self.gst_native_gio_modules_dir, relocator, strip)
-            else:
-                self.copy(f, self.gst_native, relocator, strip)
+        dest_dirs = self._get_dest_dirs()
+        copies = [(f, dest_dirs.get(f.parent, self.gst_native))
+                  for f in files.values()]
 
-        i_gst_inspect.chmod(i_gst_scanner.stat().st_mode | stat.S_IEXEC)
+        # Each copy runs install_name_tool on its own file, so they can run in
+        # parallel. The relocator is stateless and can be shared.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            copied = list(executor.map(
+                lambda c: self.copy(*c, relocator), copies))
+        self.strip([f for f in copied if f is not None], strip)
+
+        i_gst_scanner.chmod(i_gst_scanner.stat().st_mode | stat.S_IEXEC)
         i_gst_inspect.chmod(i_gst_inspect.stat().st_mode | stat.S_IEXEC)
 
         plugins = ["subprojects/gst-plugins-good/gst/isomp4/libgstisomp4.dylib"]
         for plugin in plugins:
-            universal_lib_path = self.gst_build_dir / plugin.split("/")[-1]
-            run(
-                [
-                    "lipo",
-                    self.gst_build_dir / "x86_64" / plugin,
-                    self.gst_build_dir / "arm64" / plugin,
-                    "-create",
-                    "-output",
-                    universal_lib_path,
-                ]
-            )
+            universal_lib_path = self._create_universal_lib(plugin)
             self.copy(universal_lib_path, self.gst_native_plugins, relocator, strip)
 
         libs = []
         for lib in libs:
-            universal_lib_path = self.gst_build_dir / lib.split("/")[-1]
-            run(
-                [
-                    "lipo",
-                    self.gst_build_dir / "x86_64" / lib,
-                    self.gst_build_dir / "arm64" / lib,
-                    "-create",
-                    "-output",
-                    universal_lib_path,
-                ]
-            )
+            universal_lib_path = self._create_universal_lib(lib)
             self.copy(universal_lib_path, self.gst_native, relocator, strip)
 
-        avlibs = glob.glob("/Library/Frameworks/GStreamer.framework/Versions/1.0/lib/libav*.*.*.dylib")
-        avlibs = [os.path.split(x)[-1] for x in avlibs]
-        for avlib in avlibs:
-            avlib_link = avlib.rsplit('.', 3)[0] + '.dylib'
-            run(["rm", "-f", avlib_link], self.gst_native)
-            run(["ln", "-s", avlib, avlib_link], self.gst_native)
-
-    def copy(self, src, dst_dir, relocator, strip):
+        for avlib in (self.gst_install_dir / "lib").glob("libav*.*.*.dylib"):
+            avlib_link = self.gst_native / (avlib.name.rsplit('.', 3)[0] + '.dylib')
+            avlib_link.unlink(missing_ok=True)
+            avlib_link.symlink_to(avlib.name)
+
+    def _create_universal_lib(self, lib):
+        universal_lib_path = self.gst_build_dir / lib.split("/")[-1]
+        thin_libs = [self.gst_build_dir / "x86_64" / lib,
+                     self.gst_build_dir / "arm64" / lib]
+        # Skip lipo if the universal library is newer than both slices
+        if universal_lib_path.exists():
+            mtime = universal_lib_path.stat().st_mtime_ns
+            if all(x.stat().st_mtime_ns <= mtime for x in thin_libs):
+                return universal_lib_path
+        run(["lipo"] + thin_libs + ["-create", "-output", universal_lib_path])
+        return universal_lib_path
+
+    def copy(self, src, dst_dir, relocator, strip=None):
+        ''' Copies and relocates a file, returning it if it must be stripped.
+        The file is stripped right away if 'strip' is set. '''
         filename = src.name
         dst = dst_dir / filename
-        shutil.copy(src, dst)
+        copyfile(src, dst)
         if dst.suffix in [".dylib", ".so"] or dst.name.startswith("gst-"):
             relocator.change_libs_path(dst)
-            run([strip, "-SX", dst])
-
-    def _get_gst_install_dir(self):
+            if strip is not None:
+                run([strip, "-SX", dst])
+            return dst
+
+    def strip(self, files, strip):
+        # strip accepts several files, run one batch per CPU
+        cpu_count = os.cpu_count() or 1
+        batches = [files[i::cpu_count] for i in range(cpu_count)]
+        with ThreadPoolExecutor(max_workers=cpu_count) as executor:
+            list(executor.map(lambda b: run([strip, "-SX"] + b),
+                              [b for b in batches if b]))
+
+    @cached_property
+    def gst_install_dir(self):
         return Path("/Library/Frameworks/GStreamer.framework/Versions/1.0/")
 
     def _install_package(self, path, log_file):
-        run(["sudo", "installer", "-pkg", path, "-target", "/"])
+        run(["sudo", "installer", "-pkg", path, "-target", "/"], stream=True)
 
     def _get_file_from_plugin_name(self, plugin_name):
-        return self._get_gst_install_dir() / "lib" / "gstreamer-1.0" / f'libgst{plugin_name}.dylib'
+        return self.gst_install_dir / "lib" / "gstreamer-1.0" / f'libgst{plugin_name}.dylib'
 
     def _get_file_from_lib_name(self, lib_name):
-        return self._get_gst_install_dir() / "lib" / f'lib{lib_name}.0.dylib'
+        return self.gst_install_dir / "lib" / f'lib{lib_name}.0.dylib'
 
 
 class BuildWin64(Build):
@@ -460,11 +685,9 @@ class BuildWin64(Build):
         xsltproc = Path("C:/Strawberry/c/bin/xsltproc.EXE")
         if xsltproc.exists():
             xsltproc.unlink()
-        download("https://dist.nuget.org/win-x86-commandline/latest/nuget.exe",
-                 self.cache_dir / "nuget.exe")
 
     def configure_gst(self):
-        gst_install_dir = self._get_gst_install_dir()
+        gst_install_dir = self.gst_install_dir
         os.environ["PKG_CONFIG"] = str(
             (gst_install_dir / "bin" / "pkg-config.exe").absolute())
         os.environ["PKG_CONFIG_LIBDIR"] = str(
@@ -476,42 +699,39 @@ class BuildWin64(Build):
     def install_gst(self):
         super().install_gst()
 
-        tracker = DepsTracker(platform.system(), self._get_gst_install_dir())
-        gst_install_dir = self._get_gst_install_dir()
-        files = self._get_files_from_plugins(tracker)
-        files += self._get_files_from_libs(tracker)
+        gst_install_dir = self.gst_install_dir
         gst_gio_openssl = gst_install_dir / "lib" / "gio" / "modules" / "gioopenssl.dll"
         gst_libsoup = gst_install_dir / "lib" / "soup-2.4.1.dll"
         gst_inspect = gst_install_dir / "bin" / "gst-inspect-1.0.exe"
         gst_scanner = gst_install_dir / "libexec" / "gstreamer-1.0" / "gst-plugin-scanner.exe"
-        files += tracker.list_deps([gst_gio_openssl, gst_libsoup, gst_inspect, gst_scanner])
-        files = set(files)
+        files = self._get_all_dep_files([gst_gio_openssl, gst_libsoup, gst_inspect, gst_scanner])
 
-        for f in files:
-            if "lib\\gstreamer-1.0" in str(f):
-                shutil.copy(f, self.gst_native_plugins)
-            elif "lib\\gio\\modules" in str(f):
-                shutil.copy(f, self.gst_native_gio_modules_dir)
-            else:
-                shutil.copy(f, self.gst_native)
+        dest_dirs = self._get_dest_dirs()
+        copies = [(f, dest_dirs.get(f.parent, self.gst_native)) for f in files]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(
+                lambda c: copyfile(c[0], c[1] / c[0].name), copies))
 
+        # Files built locally replace the installed ones, copy them once the
+        # pool is done so they always win
         plugins = ["subprojects/gst-plugins-good/gst/isomp4/gstisomp4.dll"]
         for plugin in plugins:
-            shutil.copy(self.gst_build_dir / plugin, self.gst_native_plugins)
+            copyfile(self.gst_build_dir / plugin,
+                     self.gst_native_plugins / Path(plugin).name)
 
         libs = []
         for lib in libs:
-            shutil.copy(self.gst_build_dir / lib, self.gst_native)
+            copyfile(self.gst_build_dir / lib, self.gst_native / Path(lib).name)
 
         # Strip GCC shared libraries
         strip = os.environ.get("STRIP", "strip.exe")
-        for av in ['avcodec', 'avformat', 'avfilter', 'avutil']:
-            for f in glob.glob(f"{self.gst_native}/{av}*.dll"):
-                run(f"{strip} -s {f}")
-        for f in glob.glob(f"{self.gst_native}/lib*dll"):
-            if 'libssl' in f:
-                continue
-            run(f"{strip} -s {f}")
+        targets = itertools.chain(
+            *(self.gst_native.glob(f"{av}*.dll")
+              for av in ['avcodec', 'avformat', 'avfilter', 'avutil']),
+            (f for f in self.gst_native.glob("lib*dll")
+             if 'libssl' not in f.name))
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(lambda f: run([strip, "-s", f]), targets))
 
     def _get_configure_cmd(self):
         gst_configure_cmd = [
@@ -533,21 +753,24 @@ class BuildWin64(Build):
         ]
         return gst_configure_cmd
 
-    def _get_gst_install_dir(self):
+    @cached_property
+    def gst_install_dir(self):
         import winreg
-        key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE,
-                             r"SOFTWARE\WOW6432Node\GStreamer1.0\x86_64",
-                             0, winreg.KEY_ALL_ACCESS)
-        return Path(winreg.QueryValueEx(key, 'InstallDir')[0]) / "1.0" / "msvc_x86_64"
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE,
+                            r"SOFTWARE\WOW6432Node\GStreamer1.0\x86_64",
+                            0, winreg.KEY_ALL_ACCESS) as key:
+            install_dir = winreg.QueryValueEx(key, 'InstallDir')[0]
+        return Path(install_dir) / "1.0" / "msvc_x86_64"
 
     def _install_package(self, path, log_file):
-        run(f"msiexec /i {path} /quiet /l* {log_file} /norestart ADDLOCAL=All")
+        run(f"msiexec /i {path} /quiet /l* {log_file} /norestart ADDLOCAL=All",
+            stream=True)
 
     def _get_file_from_plugin_name(self, plugin_name):
-        return self._get_gst_install_dir() / "lib" / "gstreamer-1.0" / f'gst{plugin_name}.dll'
+        return self.gst_install_dir / "lib" / "gstreamer-1.0" / f'gst{plugin_name}.dll'
 
     def _get_file_from_lib_name(self, lib_name):
-        return self._get_gst_install_dir() / "lib" / f'{lib_name}-0.dll'
+        return self.gst_install_dir / "lib" / f'{lib_name}-0.dll'
 
 
 if __name__ == '__main__':
@@ -15,46 +15,124 @@
 # License along with this library; if not, write to the
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
+import json
+import mmap
 import os
 import re
+import shutil
+import struct
 import subprocess
 from pathlib import Path
 
+try:
+    from macholib.MachO import MachO
+    from macholib.mach_o import (LC_ID_DYLIB, LC_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB,
+                                 LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB, LC_RPATH)
+    MACHO_DYLIB_CMDS = (LC_ID_DYLIB, LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB,
+                        LC_REEXPORT_DYLIB, LC_LOAD_UPWARD_DYLIB)
+except ImportError:
+    MachO = None
+
+try:
+    import pefile
+except ImportError:
+    pefile = None
+
+
+BATCH_SIZE = 64
+RPATH_RE = re.compile(r"cmd LC_RPATH\s+cmdsize \d+\s+path (\S+)")
+OBJDUMP_DLL_RE = re.compile(r"(?i)^.*DLL[^:]*: (\S+\.dll)$")
+DUMPBIN_DLL_RE = re.compile(r"^\s+(\S+\.dll)$")
+DYLIB_RE = re.compile(rb"(?:@rpath|@loader_path|@executable_path)?(?:/[\w.+-]+)+\.(?:dylib|so)")
+
 
 def run(cmd):
     return subprocess.run(cmd, capture_output=True).stdout.decode('utf-8').splitlines()
 
 
+def find_dlls(prefix, names):
+    files = [os.path.join(prefix, 'bin', x) for x in names if x.lower().endswith('dll')]
+    return [Path(os.path.realpath(x)) for x in files if os.path.exists(x)]
+
+
 class RecursiveLister():
 
+    def __init__(self):
+        # Dependencies already listed, keyed by path: (mtime, deps)
+        self.cache = {}
+
     def list_file_deps(self, prefix:Path, path):
         raise NotImplemented()
 
-    def find_deps(self, prefix, lib, state={}, ordered=[]):
-        if state.get(lib, 'clean') == 'processed':
-            return
-        if state.get(lib, 'clean') == 'in-progress':
-            return
-        state[lib] = 'in-progress'
-        lib_deps = self.list_file_deps(prefix, lib)
-        for libdep in lib_deps:
-            self.find_deps(prefix, libdep, state, ordered)
-        state[lib] = 'processed'
-        ordered.append(lib)
-        return ordered
+    def list_files_deps(self, prefix:Path, paths:list):
+        ''' Lists the deps of several files, returning a dict keyed by path.
+        Listers whose tool accepts several files override it to use a single
+        invocation. '''
+        return {path: self.list_file_deps(prefix, path) for path in paths}
 
-    def list_deps(self, prefix: Path, paths: list):
-        deps = set()
+    def cached_list_file_deps(self, prefix:Path, path):
+        if self._needs_listing(path):
+            self._list_and_cache(prefix, [path])
+        return self.cache.get(str(path), (0, []))[1]
+
+    def _needs_listing(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        entry = self.cache.get(str(path))
+        return entry is None or entry[0] != mtime
+
+    def _list_and_cache(self, prefix, paths):
+        for i in range(0, len(paths), BATCH_SIZE):
+            batch = paths[i:i + BATCH_SIZE]
+            found = self.list_files_deps(prefix, batch)
+            for path in batch:
+                self.cache[str(path)] = (
+                    os.stat(path).st_mtime_ns,
+                    [Path(x) for x in found.get(path, [])])
+
+    def _prefetch(self, prefix, paths):
+        # Fill the cache one level of the dependency graph at a time, so that
+        # a whole level is listed with as few invocations as possible
+        seen = set()
+        level = set(paths)
+        while level:
+            seen |= level
+            self._list_and_cache(
+                prefix, [p for p in level if self._needs_listing(p)])
+            level = {d for p in level
+                     for d in self.cache.get(str(p), (0, []))[1]} - seen
+
+    def find_deps(self, prefix, libs):
+        ''' Returns libs and all their dependencies, dependencies first '''
         state = {}
         ordered = []
-        for path in paths:
-            if not path.exists():
+        for lib in libs:
+            if lib in state:
                 continue
-            new_deps = self.find_deps(prefix, path.resolve(), state, ordered)
-            if new_deps is None:
-                continue
-            new_deps.append(path)
-            deps.update(new_deps)
+            state[lib] = 'in-progress'
+            stack = [(lib, iter(self.cached_list_file_deps(prefix, lib)))]
+            while stack:
+                node, lib_deps = stack[-1]
+                libdep = next(lib_deps, None)
+                if libdep is None:
+                    state[node] = 'processed'
+                    ordered.append(node)
+                    stack.pop()
+                elif libdep not in state:
+                    state[libdep] = 'in-progress'
+                    stack.append(
+                        (libdep, iter(self.cached_list_file_deps(prefix, libdep))))
+        return ordered
+
+    def list_deps(self, prefix: Path, paths: list):
+        paths = [p for p in paths if p.exists()]
+        libs = [p.resolve() for p in paths]
+        self._prefetch(prefix, libs)
+        # Everything found by the listers is already resolved
+        deps = set(self.find_deps(prefix, libs))
+        deps.update(libs)
         return deps
 
 
@@ -64,12 +142,9 @@ class ObjdumpLister(RecursiveLister):
         env = os.environ.copy()
         env['LC_ALL'] = 'C'
         cmd = ['objdump', '-xw', path]
-        files = subprocess.run(cmd, capture_output=True).stdout.decode('utf-8').splitlines()
-        prog = re.compile(r"(?i)^.*DLL[^:]*: (\S+\.dll)$")
-        files = [prog.sub(r"\1", x) for x in files if prog.match(x) is not None]
-        files = [os.path.join(prefix, 'bin', x) for x in files if
-                 x.lower().endswith('dll')]
-        return [os.path.realpath(x) for x in files if os.path.exists(x)]
+        files = subprocess.run(cmd, capture_output=True, env=env).stdout.decode('utf-8').splitlines()
+        files = [m.group(1) for m in filter(None, map(OBJDUMP_DLL_RE.match, files))]
+        return find_dlls(prefix, files)
 
 
 class DumpbinLister(RecursiveLister):
@@ -87,50 +162,103 @@ class DumpbinLister(RecursiveLister):
             raise FileNotFoundError("dumpbin.exe not found. Please ensure the required Visual Studio components are installed.")
 
     def list_file_deps(self, prefix:Path, path:Path):
-        cmd = [self.dumpbin_path, '/DEPENDENTS', path]
-        files = subprocess.run(cmd, capture_output=True).stdout.decode('utf-8').splitlines()
-        prog = re.compile(r"^\s+(\S+\.dll)$")
-        files = [prog.sub(r"\1", x) for x in files if prog.match(x) is not None]
-        files = [os.path.join(prefix, 'bin', x) for x in files if x.lower().endswith('dll')]
-        return [Path(os.path.realpath(x)) for x in files if os.path.exists(x)]
+        return self.list_files_deps(prefix, [path])[path]
+
+    def list_files_deps(self, prefix:Path, paths:list):
+        cmd = [self.dumpbin_path, '/DEPENDENTS'] + paths
+        # The output of each file starts with a "Dump of file <path>" line
+        names = {os.path.normcase(str(p)): p for p in paths}
+        blocks = {}
+        lines = []
+        for line in run(cmd):
+            if line.startswith("Dump of file "):
+                name = os.path.normcase(line[len("Dump of file "):].strip())
+                lines = blocks.setdefault(names.get(name), [])
+            else:
+                lines.append(line)
+        return {p: self._get_deps(prefix, blocks.get(p, [])) for p in paths}
+
+    def _get_deps(self, prefix:Path, lines:list):
+        files = [m.group(1) for m in filter(None, map(DUMPBIN_DLL_RE.match, lines))]
+        return find_dlls(prefix, files)
+
+
+class PefileLister(RecursiveLister):
+    ''' Reads the import tables with pefile instead of running dumpbin '''
+
+    def list_file_deps(self, prefix:Path, path:Path):
+        try:
+            pe = pefile.PE(str(path), fast_load=True)
+        except pefile.PEFormatError:
+            return []
+        try:
+            # Like dumpbin /DEPENDENTS, list regular and delay-load imports
+            pe.parse_data_directories(directories=[
+                pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT'],
+                pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_DELAY_IMPORT']])
+            entries = (getattr(pe, 'DIRECTORY_ENTRY_IMPORT', [])
+                       + getattr(pe, 'DIRECTORY_ENTRY_DELAY_IMPORT', []))
+            files = [e.dll.decode() for e in entries]
+        finally:
+            pe.close()
+        return find_dlls(prefix, files)
 
 
 class OtoolLister(RecursiveLister):
 
     def list_file_deps(self, prefix:Path, path:Path):
-        cmd = ['otool', '-L', path]
-        deps = set(subprocess.run(cmd, capture_output=True).stdout.decode('utf-8').splitlines())
+        return self.list_files_deps(prefix, [path])[path]
+
+    def list_files_deps(self, prefix:Path, paths:list):
+        libs = self._split_output(run(['otool', '-L'] + paths), paths)
+        load_cmds = self._split_output(run(['otool', '-l'] + paths), paths)
+        return {p: self._get_deps(
+                    prefix, p,
+                    [x.strip().split(' ')[0] for x in libs.get(p, [])],
+                    RPATH_RE.findall('\n'.join(load_cmds.get(p, []))))
+                for p in paths}
+
+    @staticmethod
+    def _split_output(lines, paths):
+        # otool prints a "<path>:" or "<path> (architecture <arch>):" header
+        # before the output of each file
+        names = {str(p): p for p in paths}
+        blocks = {}
+        current = None
+        for line in lines:
+            if line.endswith(':'):
+                name = line[:-1].split(' (architecture ')[0]
+                if name in names:
+                    current = blocks.setdefault(names[name], [])
+                    continue
+            if current is not None:
+                current.append(line)
+        return blocks
+
+    def _get_deps(self, prefix:Path, path:Path, libs:list, rpaths:list):
+        deps = set(libs)
         # Shared libraries might be relocated, we look for files with the
         # prefix or starting with @rpath
-        deps = [x.strip().split(' ')[0]
-                 for x in deps if str(prefix) in x or "@rpath" in x]
+        deps = [x for x in deps if str(prefix) in x or "@rpath" in x]
         # Remove link to the same library
         # /Library/Frameworks/GStreamer.framework/Versions/1.0/lib/gstreamer-1.0/libgstapp.dylib' -> '@rpath/libgstapp.dylib'
         deps = [d for d in deps if not d.endswith(path.name)]
-        rpaths = self._get_rpaths(path, prefix)
+        rpaths = self._get_rpaths(path, prefix, rpaths)
         deps_paths = [self._replace_rpath(x, rpaths) for x in deps]
         return deps_paths
 
-    def _get_rpaths(self, path, prefix):
-        rpaths = set()
-        cmd = ['otool', '-l', path]
-        lines_iter = iter(subprocess.run(cmd, capture_output=True).stdout.decode('utf-8').splitlines())
-        while True:
-            line = next(lines_iter, None)
-            if line is None:
-                break
-            elif "cmd LC_RPATH" in line:
-                line = next(lines_iter)
-                rpath = next(lines_iter).strip().split(' ')[1]
-                if len(rpath) == 1:
-                    rpath = rpath.replace(".", str(prefix))
-                else:
-                    rpath = rpath.replace(
-                        "@loader_path", os.path.dirname(path))
-                    rpath = rpath.replace(
-                        "@executable_path", os.path.dirname(path))
-                rpaths.add(Path(rpath))
-        return rpaths
+    def _get_rpaths(self, path, prefix, rpaths):
+        paths = set()
+        for rpath in rpaths:
+            if len(rpath) == 1:
+                rpath = rpath.replace(".", str(prefix))
+            else:
+                rpath = rpath.replace(
+                    "@loader_path", os.path.dirname(path))
+                rpath = rpath.replace(
+                    "@executable_path", os.path.dirname(path))
+            paths.add(Path(rpath))
+        return paths
 
     def _replace_rpath(self, path:str, rpaths:list):
         for rpath in rpaths:
@@ -140,6 +268,59 @@ class OtoolLister(RecursiveLister):
         return Path(path).resolve()
 
 
+class MachOLister(OtoolLister):
+    ''' Reads the load commands with macholib instead of running otool '''
+
+    def list_files_deps(self, prefix:Path, paths:list):
+        return {p: self.list_file_deps(prefix, p) for p in paths}
+
+    def list_file_deps(self, prefix:Path, path:Path):
+        try:
+            macho = MachO(str(path), allow_unknown_load_commands=True)
+        except (ValueError, struct.error):
+            # Not something macholib can parse, let otool try
+            return super().list_files_deps(prefix, [path])[path]
+        libs = []
+        rpaths = []
+        for header in macho.headers:
+            for lc, _, data in header.commands:
+                if lc.cmd in MACHO_DYLIB_CMDS:
+                    libs.append(data.split(b'\0', 1)[0].decode())
+                elif lc.cmd == LC_RPATH:
+                    rpaths.append(data.split(b'\0', 1)[0].decode())
+        return self._get_deps(prefix, path, libs, rpaths)
+
+
+class MmapLister(OtoolLister):
+    ''' Scans the binary for library paths, a last resort when neither
+    macholib nor otool are available. It can match strings that are not load
+    commands, the ones that do not exist are dropped. '''
+
+    def list_files_deps(self, prefix:Path, paths:list):
+        return {p: self.list_file_deps(prefix, p) for p in paths}
+
+    def list_file_deps(self, prefix:Path, path:Path):
+        try:
+            with open(path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                libs = {m.group(0).decode() for m in DYLIB_RE.finditer(mm)}
+        except ValueError:
+            # Empty file
+            return []
+        # The LC_RPATH entries can't be told apart, try the usual ones
+        rpaths = [str(Path(prefix) / 'lib'), '@loader_path', '@loader_path/../lib']
+        deps = self._get_deps(prefix, path, libs, rpaths)
+        return [d for d in deps if d.exists()]
+
+
+def _macos_lister():
+    if MachO is not None:
+        return MachOLister()
+    if shutil.which('otool') is not None:
+        return OtoolLister()
+    return MmapLister()
+
+
 class LddLister():
 
     def list_deps(self, prefix, path):
@@ -151,15 +332,42 @@ class LddLister():
 class DepsTracker():
 
     BACKENDS = {
-        "Windows": DumpbinLister,
+        "Windows": PefileLister if pefile else DumpbinLister,
         "Linux" : LddLister,
-        "Darwin" : OtoolLister}
+        "Darwin" : _macos_lister}
 
-    def __init__(self, platform, prefix):
+    def __init__(self, platform, prefix, cache_file=None):
         self.libs_deps = {}
         self.prefix = prefix
+        self.cache_file = cache_file
         self.lister = self.BACKENDS[platform]()
+        self._load_cache()
 
     def list_deps(self, paths:list):
         deps = self.lister.list_deps(self.prefix, paths)
-        return [d.resolve() for d in deps]
\ No newline at end of file
+        self._save_cache()
+        return list(deps)
+
+    def _load_cache(self):
+        if self.cache_file is None or not isinstance(self.lister, RecursiveLister):
+            return
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        # The listed dependencies are filtered by prefix
+        if data.get("prefix") != str(self.prefix):
+            return
+        self.lister.cache = {
+            path: (mtime, [Path(x) for x in deps])
+            for path, (mtime, deps) in data["files"].items()}
+
+    def _save_cache(self):
+        if self.cache_file is None or not isinstance(self.lister, RecursiveLister):
+            return
+        files = {
+            path: (mtime, [str(x) for x in deps])
+            for path, (mtime, deps) in self.lister.cache.items()}
+        with open(self.cache_file, "w") as f:
+            json.dump({"prefix": str(self.prefix), "files": files}, f)
@@ -19,10 +19,71 @@
 
 import os
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 
 INT_CMD = 'install_name_tool'
 OTOOL_CMD = 'otool'
+LIPO_CMD = 'lipo'
+DYLIB_CMDS = ('LC_ID_DYLIB', 'LC_LOAD_DYLIB', 'LC_LOAD_WEAK_DYLIB',
+              'LC_REEXPORT_DYLIB', 'LC_LOAD_UPWARD_DYLIB')
+# The rpaths every relocated file ends with, in this order
+RPATHS = ('.', '@loader_path', '@executable_path')
+# Libraries provided by the system, they are never relocated
+SYS_PREFIXES = ('/usr/lib', '/System/Library')
+# Thin and fat Mach-O headers, in both byte orders
+MACHO_MAGICS = (b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe', b'\xfe\xed\xfa\xcf',
+                b'\xcf\xfa\xed\xfe', b'\xca\xfe\xba\xbe', b'\xbe\xba\xfe\xca')
+# Each file is a couple of otool and install_name_tool runs, more workers
+# only add fork pressure
+MAX_WORKERS = 8
+
+
+def _mtime(object_file):
+    # Part of the cache keys, a file rewritten by install_name_tool is read
+    # again
+    return os.stat(object_file).st_mtime_ns
+
+
+@lru_cache(maxsize=4096)
+def _list_shared_libraries(object_file, mtime):
+    out = subprocess.run([OTOOL_CMD, '-L', object_file],
+                         stdout=subprocess.PIPE, text=True, check=True).stdout
+    # Skip the first line with the file name and remove the tabulation
+    # and the version info
+    return tuple(x.lstrip('\t').split(' ', 1)[0] for x in out.splitlines()[1:])
+
+
+@lru_cache(maxsize=4096)
+def _read_load_commands(object_file, mtime):
+    ''' Returns the libraries of a file and the rpaths of each architecture,
+    as ((arch, rpaths), ...). arch is None for thin files. '''
+    res = subprocess.run(
+        [OTOOL_CMD, "-l", object_file], capture_output=True, text=True, check=True
+    )
+    libs = []
+    slices = {}
+    arch = None
+    cmd = None
+    for line in res.stdout.splitlines():
+        if line.endswith(":") and not line.startswith((" ", "\t")):
+            # "<path>:" or "<path> (architecture <arch>):" starts each slice
+            if " (architecture " in line:
+                arch = line[:-2].rsplit(" (architecture ", 1)[1]
+            slices.setdefault(arch, [])
+            continue
+        line = line.strip()
+        if line.startswith("cmd "):
+            cmd = line[4:]
+        elif cmd in DYLIB_CMDS and line.startswith("name "):
+            libs.append(line[5:].rsplit(" (offset ", 1)[0])
+        elif cmd == "LC_RPATH" and line.startswith("path "):
+            slices.setdefault(arch, []).append(line[5:].rsplit(" (offset ", 1)[0])
+    # Universal binaries list the load commands once per architecture
+    return (tuple(dict.fromkeys(libs)),
+            tuple((a, tuple(r)) for a, r in slices.items()))
 
 
 class OSXRelocator(object):
@@ -32,87 +93,123 @@ class OSXRelocator(object):
     libraries paths and does not do a full relocation.
     '''
 
-    def __init__(self, recursive, logfile=None):
+    def __init__(self, recursive):
         self.recursive = recursive
         self.use_relative_paths = True
-        self.logfile = None
 
     def change_libs_path(self, object_file):
-        lib_prefixes = self._get_prefixes(object_file)
-        for lib in self.list_shared_libraries(object_file):
+        libs, slices = self._read_load_commands(object_file)
+        if len({rpaths for _, rpaths in slices}) > 1:
+            # install_name_tool edits all the architectures at once and fails
+            # if an rpath is missing in one of them
+            self._change_libs_path_per_arch(object_file, [a for a, _ in slices])
+            return
+        rpaths = slices[0][1] if slices else ()
+        lib_prefixes = self._get_prefixes(libs)
+        # install_name_tool accepts several operations, so the file is
+        # rewritten with as few invocations as possible
+        cmd = [INT_CMD]
+        for lib in libs:
             prefix = os.path.dirname(lib)
             if prefix in lib_prefixes:
-                new_lib = lib.replace(prefix, '@rpath')
-                subprocess.call(
-                    [INT_CMD, '-change', lib, new_lib, object_file])
-        self._remove_rpath(object_file)
-        for p in ['.', '@loader_path', '@executable_path']:
-            subprocess.call([INT_CMD, '-add_rpath', p, object_file])
+                new_lib = '@rpath/' + os.path.basename(lib)
+                # Libraries already relocated don't need a change
+                if new_lib != lib:
+                    cmd += ['-change', lib, new_lib]
+        # The file must end with exactly RPATHS, in order. If it already
+        # starts with them only the missing ones are added, otherwise all
+        # the rpaths are removed and added again. Deleting and adding the
+        # same rpath in one invocation fails, so that takes a second call.
+        add_cmd = [INT_CMD]
+        if rpaths == RPATHS[:len(rpaths)]:
+            for p in RPATHS[len(rpaths):]:
+                cmd += ['-add_rpath', p]
+        else:
+            for rpath in dict.fromkeys(rpaths):
+                cmd += ['-delete_rpath', rpath]
+                print(f"Removed RPATH {rpath} from {object_file}")
+            for p in RPATHS:
+                add_cmd += ['-add_rpath', p]
+        # Rewriting the file is the expensive part, skip it when there is
+        # nothing to change. A rejected edit must not leave the file half
+        # relocated silently.
+        for c in (cmd, add_cmd):
+            if len(c) > 1:
+                subprocess.run(c + [object_file], check=True)
+
+    def _change_libs_path_per_arch(self, object_file, archs):
+        # Relocate each architecture on its own and merge them back
+        with tempfile.TemporaryDirectory() as tmpdir:
+            thin_files = []
+            for arch in archs:
+                thin_file = os.path.join(tmpdir, arch)
+                subprocess.run([LIPO_CMD, object_file, '-thin', arch,
+                                '-output', thin_file], check=True)
+                self.change_libs_path(thin_file)
+                thin_files.append(thin_file)
+            subprocess.run([LIPO_CMD, '-create'] + thin_files +
+                           ['-output', object_file], check=True)
+
+    def change_libs_path_many(self, files):
+        ''' Relocates several files in parallel. The work is done by otool
+        and install_name_tool, so threads are enough. '''
+        workers = min(MAX_WORKERS, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.change_libs_path, files))
+
+    def list_object_files(self, path):
+        ''' Returns the Mach-O files in a directory, and in its
+        subdirectories if the relocator is recursive '''
+        if self.recursive:
+            files = [os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs]
+        else:
+            files = [e.path for e in os.scandir(path)]
+        return [f for f in files if not os.path.islink(f) and self._is_mach_o(f)]
+
+    @staticmethod
+    def _is_mach_o(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(4) in MACHO_MAGICS
+        except OSError:
+            return False
 
     @staticmethod
     def list_shared_libraries(object_file):
-        res = subprocess.getoutput(
-            "{} -L {}".format(OTOOL_CMD, object_file)).splitlines()
-        # We don't use the first line
-        libs = res[1:]
-        # Remove the first character tabulation
-        libs = [str(x[1:]) for x in libs]
-        # Remove the version info
-        libs = [x.split(' ', 1)[0] for x in libs]
-        return libs
-
-    def _remove_rpath(self, object_file):
-        # Get the current RPATHs
-        result = subprocess.run(
-            ["otool", "-l", object_file], capture_output=True, text=True, check=True
-        )
-        lines = result.stdout.splitlines()
-        rpaths = [
-            lines[i + 2].strip().split(" ")[1]
-            for i, line in enumerate(lines)
-            if "cmd LC_RPATH" in line and lines[i + 2].strip().startswith("path")
-        ]
-
-        # Remove each RPATH
-        for rpath in set(rpaths):
-            subprocess.run(
-                ["install_name_tool", "-delete_rpath", rpath, object_file],
-                check=False,
-            )
-            print(f"Removed RPATH {rpath} from {object_file}")
-
-    def _get_prefixes(self, object_file):
-        prefixes = set([os.path.dirname(x)
-                       for x in self.list_shared_libraries(object_file)])
-        return [x for x in prefixes if not x.startswith(('/usr/lib', '/System/Library'))]
-
-    def _fix_path(self, path):
-        if path.endswith('/'):
-            return path[:-1]
-        return path
+        return list(_list_shared_libraries(str(object_file), _mtime(object_file)))
+
+    @staticmethod
+    def _read_load_commands(object_file):
+        ''' Returns the libraries and the rpaths of each architecture of a
+        file from a single otool run. The load commands already contain the
+        libraries, so there is no need to call otool -L as well. '''
+        return _read_load_commands(str(object_file), _mtime(object_file))
+
+    def _get_prefixes(self, libs):
+        return {d for d in map(os.path.dirname, libs) if not d.startswith(SYS_PREFIXES)}
 
 
 class Main(object):
 
     def run(self):
-        # We use OptionParser instead of ArgumentsParse because this script
-        # might be run in OS X 10.6 or older, which do not provide the argparse
-        # module
-        import optparse
-        usage = "usage: %prog [options] library_path"
+        # Only needed by the command line, importing osxrelocator as a
+        # library doesn't pay for it
+        import argparse
         description = 'Rellocates object files changing the dependant '\
                       ' dynamic libraries location path with a new one'
-        parser = optparse.OptionParser(usage=usage, description=description)
-        parser.add_option('-r', '--recursive', action='store_true',
-                          default=False, dest='recursive',
-                          help='Scan directories recursively')
-
-        options, args = parser.parse_args()
-        if len(args) != 1:
-            parser.print_usage()
-            exit(1)
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('library_path',
+                            help='Object file or directory to relocate')
+        parser.add_argument('-r', '--recursive', action='store_true',
+                            default=False, help='Scan directories recursively')
+
+        options = parser.parse_args()
         relocator = OSXRelocator(options.recursive)
-        relocator.change_libs_path(args[0])
+        if os.path.isdir(options.library_path):
+            relocator.change_libs_path_many(
+                relocator.list_object_files(options.library_path))
+        else:
+            relocator.change_libs_path(options.library_path)
         exit(0)
 
 
@@ -1,73 +1,80 @@
 #!/usr/bin/env python3
 from functools import total_ordering
-import subprocess
+import os
 import sys
-import argparse
+
+# Parsed versions, keyed by (version_str, hash). Versions are immutable, so
+# the same instance can be shared.
+_POOL = {}
 
 
 @total_ordering
 class Version:
+    __slots__ = ("major", "minor", "patch", "build", "hash", "_str", "_hash")
+
     def __init__(self, major: int, minor: int, patch: int, build: int = 0, hash=None):
-        self.major = major
-        self.minor = minor
-        self.patch = patch
-        self.build = build
-        self.hash = hash
+        # Instances are shared by parse(), so they can't be modified once
+        # created. The string and the hash are computed on first use.
+        set_attr = object.__setattr__
+        set_attr(self, "major", major)
+        set_attr(self, "minor", minor)
+        set_attr(self, "patch", patch)
+        set_attr(self, "build", build)
+        set_attr(self, "hash", hash)
+        set_attr(self, "_str", None)
+        set_attr(self, "_hash", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Version is immutable, can't set '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Version is immutable, can't delete '{name}'")
 
     def __str__(self):
-        return f"{self.major}.{self.minor}.{self.patch}.{self.build}"
+        if self._str is None:
+            object.__setattr__(
+                self, "_str", f"{self.major}.{self.minor}.{self.patch}.{self.build}"
+            )
+        return self._str
 
     def __repr__(self) -> str:
         return self.__str__()
 
+    def _key(self):
+        return (self.major, self.minor, self.patch, self.build)
+
     def __eq__(self, value: object) -> bool:
         if not isinstance(value, Version):
             return NotImplemented
-        return (
-            self.major == value.major
-            and self.minor == value.minor
-            and self.patch == value.patch
-            and self.build == value.build
-        )
+        return self._key() == value._key()
 
     def __lt__(self, value: object) -> bool:
         if not isinstance(value, Version):
             return NotImplemented
-        if self.major < value.major:
-            return True
-        if self.major > value.major:
-            return False
-        if self.minor < value.minor:
-            return True
-        if self.minor > value.minor:
-            return False
-        if self.patch < value.patch:
-            return True
-        if self.patch > value.patch:
-            return False
-        if self.build < value.build:
-            return True
-        if self.build > value.build:
-            return False
-        return False
+        return self._key() < value._key()
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash(self._key()))
+        return self._hash
 
     @staticmethod
     def parse(version_str: str, hash: str = None):
-        parts = version_str.split(".")
+        key = (version_str, hash)
+        version = _POOL.get(key)
+        if version is not None:
+            return version
+
+        parts = version_str.split(".", 3)
         if len(parts) < 2:
             raise ValueError(f"Invalid version string '{version_str}'")
 
-        major = int(parts[0])
-        minor = int(parts[1])
-        if len(parts) == 3:
-            patch = int(parts[2])
-        else:
-            patch = 0
-        build = 0
-        if len(parts) > 3:
-            build = int(parts[3])
+        # Missing patch and build numbers default to 0
+        parts += ["0"] * (4 - len(parts))
+        major, minor, patch, build = (int(p) for p in parts)
 
-        return Version(major, minor, patch, build, hash)
+        version = _POOL[key] = Version(major, minor, patch, build, hash)
+        return version
 
 
 def _get_version_from_file(file_path: str) -> Version:
@@ -75,87 +82,103 @@ def _get_version_from_file(file_path: str) -> Version:
         return Version.parse(file.readline().strip())
 
 
-def _get_commit_list(git_dir, vcommit, head_commit):
+def _git(*args, cwd):
+    # Imported on use, the Version class doesn't need it
+    import subprocess
+
+    return subprocess.check_output(
+        ["git", *args], cwd=cwd, text=True, stderr=subprocess.DEVNULL
+    ).strip()
+
+
+def _get_num_commits(git_dir, vcommit, head_commit):
+    import subprocess
+
     try:
-        commit_list = subprocess.check_output(
-            ["git", "rev-list", f"{vcommit}..{head_commit}"],
-            stderr=subprocess.DEVNULL,
-            cwd=git_dir,
-        )
-        return commit_list.decode("utf-8").split()
+        return int(_git("rev-list", "--count", f"{vcommit}..{head_commit}", cwd=git_dir))
     except subprocess.CalledProcessError:
         print("WARNING: git rev-list failed", file=sys.stderr)
-        return []
+        return 0
+
 
+def _describe(git_dir, commit):
+    """Returns the last tagged version, the number of commits since the tag and
+    the short hash of commit, all from a single git describe call."""
+    import subprocess
 
-def _get_tagged_versions(git_dir) -> list[Version]:
     try:
-        versions_tags = (
-            subprocess.check_output(
-                [
-                    "git",
-                    "describe",
-                    "--tags",
-                    "--abbrev=0",
-                    "--match=[0-9]*.[0-9]*.[0-9]*",
-                ],
-                stderr=subprocess.DEVNULL,
-                cwd=git_dir,
-            )
-            .decode("utf-8")
-            .split()
+        description = _git(
+            "describe",
+            "--tags",
+            "--long",
+            "--abbrev=7",
+            "--match=[0-9]*.[0-9]*.[0-9]*",
+            commit,
+            cwd=git_dir,
         )
-        return sorted([Version.parse(v, v) for v in versions_tags])
     except subprocess.CalledProcessError:
         print("WARNING: failed to list tags", file=sys.stderr)
-        return []
-
-
-def _get_num_commits(commit_list):
-    return len(commit_list)
+        return None
+    # <tag>-<number of commits>-g<hash>
+    tag, num_commits, commit_hash = description.rsplit("-", 2)
+    return Version.parse(tag, tag), int(num_commits), commit_hash[1:]
 
 
 def _get_current_commit_hash(git_dir):
-    return (
-        subprocess.check_output(["git", "rev-parse", "--short=7", "HEAD"], cwd=git_dir)
-        .decode("utf-8")
-        .strip()
-    )
+    return _git("rev-parse", "--short=7", "HEAD", cwd=git_dir)
 
 
 def get_version(git_dir=".", version_file="version.txt", current_commit_hash=None):
     version = _get_version_from_file(version_file)
-    current_commit_hash = current_commit_hash or _get_current_commit_hash(git_dir)
-    tagged_versions = _get_tagged_versions(git_dir)
+    if os.environ.get("LONGOMATCH_SKIP_GIT") == "1":
+        # Use the version file as is, without a build number from git
+        return Version(
+            version.major,
+            version.minor,
+            version.patch,
+            version.build,
+            current_commit_hash,
+        )
+
+    description = _describe(git_dir, current_commit_hash or "HEAD")
+    if description is None:
+        last_tagged_version = Version(0, 0, 0)
+        num_commits = 0
+        current_commit_hash = current_commit_hash or _get_current_commit_hash(git_dir)
+    else:
+        last_tagged_version, num_commits, commit_hash = description
+        current_commit_hash = current_commit_hash or commit_hash
 
-    last_tagged_version = tagged_versions[-1] if tagged_versions else Version(0, 0, 0)
     if version > last_tagged_version:
-        vcommit = (
-            subprocess.check_output(
-                ["git", "log", "-n", "1", "--pretty=format:%H", "--", version_file],
-                cwd=git_dir,
-            )
-            .decode("utf-8")
-            .strip()
+        vcommit = _git(
+            "log", "-n", "1", "--pretty=format:%H", "--", version_file, cwd=git_dir
         )
+        num_commits = _get_num_commits(git_dir, vcommit, current_commit_hash)
     else:
-        # Increase the patch version +1 of the last tagged version
+        # Increase the patch version +1 of the last tagged version, git
+        # describe already counted the commits since the tag
         version = Version(
             last_tagged_version.major,
             last_tagged_version.minor,
             last_tagged_version.patch + 1,
         )
-        vcommit = last_tagged_version.hash
-
-    commit_list = _get_commit_list(git_dir, vcommit, current_commit_hash)
-    version.build = _get_num_commits(commit_list)
-    version.hash = current_commit_hash
 
-    return version
+    return Version(
+        version.major,
+        version.minor,
+        version.patch,
+        num_commits,
+        current_commit_hash,
+    )
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Generate version information.")
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Generate version information.",
+        epilog="Set LONGOMATCH_SKIP_GIT=1 to use the version file without git.",
+    )
     parser.add_argument(
         "version_file",
         type=str,
@@ -182,10 +205,13 @@ if __name__ == "__main__":
     args = parser.parse_args()
     version = get_version(".", args.version_file, args.commit_hash)
 
-    if args.version_type == "short":
+    if args.version_type == "short" or version.hash is None:
         final_version = f"{version}"
     else:
         final_version = f"{version}-{version.hash}"
 
     # Omit the trailing newline, so we can use the result directly.
-    print(final_version, end="")
+    sys.stdout.write(final_version)
+    sys.stdout.flush()
+    # Nothing is left to clean up, skip the interpreter teardown
+    os._exit(0)